@@ -5,26 +5,157 @@ Supports latest Gemini models: 3 Pro, 2.5 Pro, 2.5 Flash
 Updated to use new google-genai SDK
 """
 
+import asyncio
+import hashlib
+import logging
 import os
+import time
+from collections import OrderedDict
 from google import genai
 from google.genai import types
 from constants import settings
+from http_session import get_session, close_session
 from typing import AsyncGenerator, Optional
 
+log = logging.getLogger("g3h.ai")
+
+# Process-wide client so every request reuses the same pooled connections
+_CLIENT: Optional[genai.Client] = None
+
+# Explicit context caching for long conversation prefixes
+CACHE_TTL_SECONDS = 600
+# Gemini's minimum cacheable size in tokens (1,024 for Flash models, 4,096
+# for Pro), converted to characters at ~4 per token
+CACHE_MIN_TOKENS = {"flash": 1024, "pro": 4096}
+CACHE_CHARS_PER_TOKEN = 4
+_CACHE_MAX_ENTRIES = 256
+_PREFIX_CACHES: "OrderedDict[str, tuple[str, float]]" = OrderedDict()  # digest -> (cache name, expiry)
+_PENDING_CACHES: dict[str, asyncio.Task] = {}
+
+# Identical short prompts already in flight share one upstream stream
+COALESCE_MAX_PROMPT_CHARS = 256
+_INFLIGHT_STREAMS: dict[tuple, "_StreamFanout"] = {}
+
+# Per-session converted history so each turn only builds Content for new messages
+_HISTORY_MAX_SESSIONS = 1024
+_HISTORY_CACHE: "OrderedDict[str, tuple[list[types.Content], list[str]]]" = OrderedDict()  # session -> (contents, digests)
+
 
 def _get_client() -> genai.Client:
-    """Get a configured Gemini client"""
-    api_key = settings.google_api_key or os.getenv("GOOGLE_API_KEY") or os.getenv("GEMINI_API_KEY")
-    if api_key:
-        return genai.Client(api_key=api_key)
-    return genai.Client()
+    """
+    Get the shared Gemini client, creating it on first use
+
+    Async calls go through the app-wide aiohttp session rather than the SDK's
+    threaded httpx fallback. Must be first called from a running event loop.
+    """
+    global _CLIENT
+    if _CLIENT is None:
+        api_key = settings.google_api_key or os.getenv("GOOGLE_API_KEY") or os.getenv("GEMINI_API_KEY")
+        http_options = types.HttpOptions(aiohttp_client=get_session())
+        if api_key:
+            _CLIENT = genai.Client(api_key=api_key, http_options=http_options)
+        else:
+            _CLIENT = genai.Client(http_options=http_options)
+    return _CLIENT
+
+
+async def close_client() -> None:
+    """Drop the shared client and close its HTTP session (call on app shutdown)"""
+    global _CLIENT
+    _CLIENT = None
+    await close_session()
+
+
+def _prefix_digests(model_name: str, messages: list[dict]) -> list[str]:
+    """Rolling SHA-256 digests where entry i identifies messages[:i + 1] for this model"""
+    digest = hashlib.sha256(model_name.encode("utf-8"))
+    digests = []
+    for msg in messages:
+        digest.update(msg["role"].encode("utf-8") + b"\0" + msg["content"].encode("utf-8") + b"\0")
+        digests.append(digest.copy().hexdigest())
+    return digests
+
+
+def _lookup_prefix_cache(digests: list[str]) -> tuple[Optional[str], int]:
+    """Find the longest live cached prefix; returns (cache name, number of messages covered)"""
+    now = time.monotonic()
+    for i in range(len(digests) - 1, -1, -1):
+        entry = _PREFIX_CACHES.get(digests[i])
+        if entry is None:
+            continue
+        name, expires_at = entry
+        if expires_at <= now:
+            del _PREFIX_CACHES[digests[i]]
+            continue
+        _PREFIX_CACHES.move_to_end(digests[i])
+        return name, i + 1
+    return None, 0
+
+
+def _to_content(msg: dict) -> types.Content:
+    """Convert a {'role', 'content'} message dict to Gemini content format"""
+    role = "user" if msg["role"] == "user" else "model"
+    return types.Content(
+        role=role,
+        parts=[types.Part.from_text(text=msg["content"])]
+    )
+
+
+def _session_contents(session_id: str, messages: list[dict], digests: list[str]) -> list[types.Content]:
+    """Return Content for messages, reusing the session's already-converted history"""
+    entry = _HISTORY_CACHE.get(session_id)
+    if entry is not None:
+        contents, cached_digests = entry
+        # Rolling digests: a matching last entry means the whole stored prefix is unchanged
+        if not cached_digests or (
+            len(cached_digests) <= len(digests) and cached_digests[-1] == digests[len(cached_digests) - 1]
+        ):
+            _HISTORY_CACHE.move_to_end(session_id)
+        else:
+            entry = None
+
+    if entry is None:
+        contents, cached_digests = [], []
+        _HISTORY_CACHE[session_id] = (contents, cached_digests)
+        while len(_HISTORY_CACHE) > _HISTORY_MAX_SESSIONS:
+            _HISTORY_CACHE.popitem(last=False)
+
+    for msg in messages[len(contents):]:
+        contents.append(_to_content(msg))
+    cached_digests[:] = digests
+    return contents
+
+
+def _cache_min_chars(model_name: str) -> int:
+    """Smallest prefix (in characters) worth caching for a model"""
+    min_tokens = CACHE_MIN_TOKENS["flash" if "flash" in model_name else "pro"]
+    return min_tokens * CACHE_CHARS_PER_TOKEN
+
+
+async def _create_prefix_cache(client: genai.Client, model_name: str, key: str, contents: list) -> None:
+    """Create a server-side context cache for a conversation prefix"""
+    try:
+        cache = await client.aio.caches.create(
+            model=model_name,
+            config=types.CreateCachedContentConfig(contents=contents, ttl=f"{CACHE_TTL_SECONDS}s"),
+        )
+        # Expire locally a little early so we never reference a cache the server dropped
+        _PREFIX_CACHES[key] = (cache.name, time.monotonic() + CACHE_TTL_SECONDS - 30)
+        while len(_PREFIX_CACHES) > _CACHE_MAX_ENTRIES:
+            _PREFIX_CACHES.popitem(last=False)
+    except Exception as e:
+        # Model without caching support or prefix under the token minimum
+        log.debug("[Context Cache] Skipped: %s", e)
+    finally:
+        _PENDING_CACHES.pop(key, None)
 
 
 async def stream_gemini_response(
     prompt: str,
     model_name: str = "gemini-2.5-flash",
     temperature: float = 0.7,
-    max_output_tokens: Optional[int] = None
+    max_output_tokens: Optional[int] = None,
+    service_tier: Optional[str] = None
 ) -> AsyncGenerator[str, None]:
     """
     Stream text response from Gemini
@@ -34,6 +165,7 @@ async def stream_gemini_response(
         model_name: Gemini model to use (gemini-3-pro-preview, gemini-2.5-pro, gemini-2.5-flash, gemini-2.5-flash-lite)
         temperature: Controls randomness (0.0-2.0)
         max_output_tokens: Maximum tokens in response
+        service_tier: Optional serving tier ("standard", "flex" or "priority")
 
     Yields:
         Text chunks as they arrive
@@ -44,6 +176,8 @@ async def stream_gemini_response(
         config_dict = {"temperature": temperature}
         if max_output_tokens:
             config_dict["max_output_tokens"] = max_output_tokens
+        if service_tier:
+            config_dict["service_tier"] = service_tier
 
         async for chunk in await client.aio.models.generate_content_stream(
             model=model_name,
@@ -57,18 +191,108 @@ async def stream_gemini_response(
         yield f"Error: {str(e)}"
 
 
+class _StreamFanout:
+    """One upstream response stream replayed to every subscriber"""
+
+    def __init__(self):
+        self.chunks: list[str] = []
+        self.done = False
+        self._changed = asyncio.Event()
+        self.task: Optional[asyncio.Task] = None
+
+    def publish(self, chunk: str) -> None:
+        self.chunks.append(chunk)
+        self._changed.set()
+
+    def close(self) -> None:
+        self.done = True
+        self._changed.set()
+
+    async def subscribe(self) -> AsyncGenerator[str, None]:
+        # Late subscribers first replay what has already arrived
+        index = 0
+        while True:
+            while index < len(self.chunks):
+                yield self.chunks[index]
+                index += 1
+            if self.done:
+                return
+            self._changed.clear()
+            await self._changed.wait()
+
+
+async def _pump_stream(key: tuple, fanout: _StreamFanout, **kwargs) -> None:
+    """Drive a single upstream stream into its fanout"""
+    try:
+        async for chunk in stream_gemini_response(**kwargs):
+            fanout.publish(chunk)
+    finally:
+        fanout.close()
+        _INFLIGHT_STREAMS.pop(key, None)
+
+
+async def coalesced_gemini_response(
+    prompt: str,
+    model_name: str = "gemini-2.5-flash",
+    temperature: float = 0.7,
+    max_output_tokens: Optional[int] = None,
+    service_tier: Optional[str] = None
+) -> AsyncGenerator[str, None]:
+    """
+    Stream text response from Gemini, collapsing identical concurrent requests
+
+    Short prompts whose exact request is already streaming attach to that
+    upstream call instead of opening a new one. Long prompts go straight through.
+
+    Args:
+        Same as stream_gemini_response
+
+    Yields:
+        Text chunks as they arrive
+    """
+    kwargs = {
+        "prompt": prompt,
+        "model_name": model_name,
+        "temperature": temperature,
+        "max_output_tokens": max_output_tokens,
+        "service_tier": service_tier,
+    }
+    if len(prompt) > COALESCE_MAX_PROMPT_CHARS:
+        async for chunk in stream_gemini_response(**kwargs):
+            yield chunk
+        return
+
+    key = (prompt, model_name, temperature, max_output_tokens, service_tier)
+    fanout = _INFLIGHT_STREAMS.get(key)
+    if fanout is None:
+        fanout = _StreamFanout()
+        _INFLIGHT_STREAMS[key] = fanout
+        fanout.task = asyncio.create_task(_pump_stream(key, fanout, **kwargs))
+
+    async for chunk in fanout.subscribe():
+        yield chunk
+
+
 async def chat_with_history(
     messages: list[dict],
     model_name: str = "gemini-2.5-flash",
     temperature: float = 0.7,
+    session_id: Optional[str] = None,
+    service_tier: Optional[str] = None,
 ) -> AsyncGenerator[str, None]:
     """
     Stream chat response with conversation history
 
+    Long histories are pinned in a Gemini context cache so later turns only
+    send the messages added since the cached prefix.
+
     Args:
         messages: List of message dicts with 'role' and 'content'
         model_name: Gemini model to use
         temperature: Controls randomness (0.0-2.0)
+        session_id: Optional conversation id; converted history is kept
+            between turns so only new messages are rebuilt
+        service_tier: Optional serving tier ("standard", "flex" or "priority")
 
     Yields:
         Text chunks as they arrive
@@ -76,21 +300,33 @@ async def chat_with_history(
     try:
         client = _get_client()
         
+        digests = _prefix_digests(model_name, messages)
+
         # Convert messages to Gemini content format
-        contents = []
-        for msg in messages:
-            role = "user" if msg["role"] == "user" else "model"
-            contents.append(
-                types.Content(
-                    role=role,
-                    parts=[types.Part.from_text(text=msg["content"])]
-                )
+        if session_id:
+            contents = _session_contents(session_id, messages, digests)
+        else:
+            contents = [_to_content(msg) for msg in messages]
+
+        # Reuse the longest cached prefix (never the final message)
+        prefix_digests = digests[:-1]
+        cached_name, cached_count = _lookup_prefix_cache(prefix_digests)
+
+        # Cache the current prefix in the background once enough new history has piled up
+        uncached_chars = sum(len(msg["content"]) for msg in messages[cached_count:-1])
+        if uncached_chars >= _cache_min_chars(model_name) and prefix_digests[-1] not in _PENDING_CACHES:
+            _PENDING_CACHES[prefix_digests[-1]] = asyncio.create_task(
+                _create_prefix_cache(client, model_name, prefix_digests[-1], contents[:-1])
             )
 
+        config = types.GenerateContentConfig(temperature=temperature, service_tier=service_tier)
+        if cached_name:
+            config.cached_content = cached_name
+
         async for chunk in await client.aio.models.generate_content_stream(
             model=model_name,
-            contents=contents,
-            config=types.GenerateContentConfig(temperature=temperature)
+            contents=contents[cached_count:],
+            config=config
         ):
             if chunk.text:
                 yield chunk.text
@@ -99,9 +335,29 @@ async def chat_with_history(
         yield f"Error: {str(e)}"
 
 
+def _split_thinking(response: types.GenerateContentResponse) -> dict:
+    """Split a thinking-model response into 'thinking' and 'response' text"""
+    parts = response.candidates[0].content.parts
+
+    thinking = "\n".join(
+        str(part.text) if hasattr(part, 'text') else str(part)
+        for part in parts if getattr(part, 'thought', False)
+    )
+    answer = "\n".join(
+        part.text
+        for part in parts if not getattr(part, 'thought', False) and getattr(part, 'text', None)
+    )
+
+    return {
+        "thinking": thinking or None,
+        "response": answer or response.text
+    }
+
+
 async def generate_with_thinking(
     prompt: str,
-    model_name: str = "gemini-3-pro-preview"
+    model_name: str = "gemini-3-pro-preview",
+    service_tier: Optional[str] = None
 ) -> dict:
     """
     Generate response with thinking process (non-streaming for thinking models)
@@ -109,6 +365,7 @@ async def generate_with_thinking(
     Args:
         prompt: User's prompt/message
         model_name: Thinking-capable model (gemini-3-pro-preview or gemini-2.5-pro)
+        service_tier: Optional serving tier ("standard", "flex" or "priority")
 
     Returns:
         Dict with 'thinking' and 'response' fields
@@ -116,29 +373,98 @@ async def generate_with_thinking(
     try:
         client = _get_client()
 
+        config = None
+        if service_tier:
+            config = types.GenerateContentConfig(service_tier=service_tier)
+
         response = await client.aio.models.generate_content(
             model=model_name,
             contents=prompt,
+            config=config,
         )
 
         # Extract thinking and final response if available
-        thinking_parts = []
-        response_parts = []
+        return _split_thinking(response)
+
+    except Exception as e:
+        return {
+            "thinking": None,
+            "response": f"Error: {str(e)}"
+        }
+
+
+async def submit_thinking_batch(
+    prompt: str,
+    model_name: str = "gemini-3-pro-preview"
+) -> dict:
+    """
+    Queue a thinking request on the Batch tier (discounted, asynchronous)
+
+    Args:
+        prompt: User's prompt/message
+        model_name: Thinking-capable model (gemini-3-pro-preview or gemini-2.5-pro)
 
-        for part in response.candidates[0].content.parts:
-            if hasattr(part, 'thought') and part.thought:
-                thinking_parts.append(str(part.text) if hasattr(part, 'text') else str(part))
-            elif hasattr(part, 'text') and part.text:
-                response_parts.append(part.text)
+    Returns:
+        Dict with 'job_id' and 'state' fields
+    """
+    try:
+        client = _get_client()
+
+        job = await client.aio.batches.create(
+            model=model_name,
+            src=[types.InlinedRequest(contents=prompt)],
+        )
 
         return {
-            "thinking": "\n".join(thinking_parts) if thinking_parts else None,
-            "response": "\n".join(response_parts) if response_parts else response.text
+            "job_id": job.name,
+            "state": job.state.value if job.state else None
         }
 
     except Exception as e:
         return {
+            "job_id": None,
+            "state": None,
+            "error": f"Error: {str(e)}"
+        }
+
+
+async def get_thinking_batch(job_id: str) -> dict:
+    """
+    Poll a batch thinking job
+
+    Args:
+        job_id: Batch job name returned by submit_thinking_batch
+
+    Returns:
+        Dict with 'job_id', 'state', 'thinking' and 'response' fields;
+        'thinking' and 'response' stay None until the job has succeeded
+    """
+    try:
+        client = _get_client()
+
+        job = await client.aio.batches.get(name=job_id)
+        result = {
+            "job_id": job.name,
+            "state": job.state.value if job.state else None,
             "thinking": None,
-            "response": f"Error: {str(e)}"
+            "response": None
         }
 
+        if job.state == types.JobState.JOB_STATE_SUCCEEDED and job.dest and job.dest.inlined_responses:
+            inlined = job.dest.inlined_responses[0]
+            if inlined.response:
+                result.update(_split_thinking(inlined.response))
+            elif inlined.error:
+                result["response"] = f"Error: {inlined.error.message}"
+        elif job.error:
+            result["response"] = f"Error: {job.error.message}"
+
+        return result
+
+    except Exception as e:
+        return {
+            "job_id": job_id,
+            "state": None,
+            "thinking": None,
+            "response": f"Error: {str(e)}"
+        }
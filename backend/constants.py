@@ -3,6 +3,7 @@ Constants for the application
 """
 
 import os
+from types import SimpleNamespace
 from pydantic_settings import BaseSettings
 
 
@@ -35,8 +36,9 @@ class Settings(BaseSettings):
     }
 
 
-# Initialize settings
-settings = Settings()
+# Initialize settings - parse and validate the environment once, then expose
+# the values as a plain namespace so lookups skip pydantic's model machinery
+settings = SimpleNamespace(**Settings().model_dump())
 
 # Additional constants - Latest Gemini Models (2025)
 DEFAULT_GEMINI_MODEL = "gemini-2.5-flash"  # Best price-performance
@@ -45,5 +47,47 @@ GEMINI_25_PRO = "gemini-2.5-pro"  # Best for complex reasoning
 GEMINI_25_FLASH = "gemini-2.5-flash"  # Best for large-scale processing
 GEMINI_25_FLASH_LITE = "gemini-2.5-flash-lite"  # Fastest, most cost-efficient
 
+# Model catalogue served by /api/models (built once, not per request)
+AVAILABLE_MODELS = {
+    "gemini-3-pro-preview": {
+        "name": "Gemini 3 Pro",
+        "description": "Best model for multimodal understanding",
+        "context_window": "1M tokens",
+        "use_case": "Complex multimodal tasks with text, images, video, audio"
+    },
+    "gemini-2.5-pro": {
+        "name": "Gemini 2.5 Pro",
+        "description": "State-of-the-art thinking model",
+        "context_window": "1M tokens",
+        "use_case": "Complex reasoning in code, math, and STEM domains"
+    },
+    "gemini-2.5-flash": {
+        "name": "Gemini 2.5 Flash",
+        "description": "Well-rounded with strong price-performance",
+        "context_window": "1M tokens",
+        "use_case": "Large-scale processing, low-latency, high volume tasks"
+    },
+    "gemini-2.5-flash-lite": {
+        "name": "Gemini 2.5 Flash Lite",
+        "description": "Fastest flash model optimized for cost-efficiency",
+        "context_window": "1M tokens",
+        "use_case": "Speed-prioritized applications with high throughput"
+    }
+}
+
 MAX_TOKENS = 8192
 TEMPERATURE = 0.7
+
+# Gemini service tiers - interactive chat goes to Priority for the lowest latency
+INTERACTIVE_SERVICE_TIER = "priority"
+
+# Streaming writes - flush buffered text at ~50 tokens or every 25 ms
+STREAM_FLUSH_CHARS = 200
+STREAM_FLUSH_INTERVAL = 0.025
+
+# Image responses - base64 is streamed in 192 KiB raw blocks (256 KiB encoded);
+# must be a multiple of 3 so blocks encode without padding
+IMAGE_B64_CHUNK_BYTES = 3 * 64 * 1024
+
+# In DEBUG mode, asyncio logs any event-loop step that blocks longer than this
+SLOW_CALLBACK_SECONDS = 0.005
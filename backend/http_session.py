@@ -0,0 +1,33 @@
+"""
+Shared HTTP Session
+One aiohttp session, and so one keep-alive connection pool, shared by every
+outbound API client in the app (chat and image generation).
+"""
+
+from typing import Optional
+
+import aiohttp
+
+_SESSION: Optional[aiohttp.ClientSession] = None
+
+
+def get_session() -> aiohttp.ClientSession:
+    """
+    Get the shared aiohttp session, creating it on first use.
+
+    Must be called from a running event loop.
+    """
+    global _SESSION
+    if _SESSION is None or _SESSION.closed:
+        _SESSION = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=200, limit_per_host=100, keepalive_timeout=30)
+        )
+    return _SESSION
+
+
+async def close_session() -> None:
+    """Close the shared session (call on app shutdown)."""
+    global _SESSION
+    if _SESSION is not None:
+        await _SESSION.close()
+        _SESSION = None
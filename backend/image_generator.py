@@ -5,13 +5,17 @@ Generate images from reference images using Gemini's image generation API.
 Uses gemini-3-pro-image-preview model with 4K resolution.
 """
 
-import base64
+import asyncio
+import mimetypes
 import os
+import time
 from typing import Optional
 
-from google import genai
 from google.genai import types
 
+from ai_assistant import _get_client
+from watermark import detect_mime
+
 # Generic prompt (no secret info yet - to be enhanced later)
 DEFAULT_IMAGE_PROMPT = """Generate a professional high-quality digital portrait 
 incorporating the visual elements and style from the provided reference images. 
@@ -20,11 +24,20 @@ Create a cohesive, polished result that blends the references harmoniously.
 Your generation should be of high quality and worthy of sharing on social media and elsewhere. The bar is super high, pay close attention to fidelity and closeness with reference images.
 """
 
+# Log the model's accompanying text parts (off by default)
+VERBOSE_GEMINI_TEXT = os.getenv("VERBOSE_GEMINI_TEXT", "").lower() in ("1", "true", "yes")
+
+# Where generated images are archived
+SAVE_DIR = "generated_images"
+
+# Strong references to in-flight save tasks so they are not garbage collected
+_SAVE_TASKS: set[asyncio.Task] = set()
+
 # Check if we're in mock mode (no API key)
 MOCK_MODE = False #not os.getenv("GOOGLE_API_KEY") and not os.getenv("GEMINI_API_KEY")
 
 
-async def generate_image_from_references(
+async def _generate_with_gemini(
     reference_images: list[bytes],
     prompt: str = DEFAULT_IMAGE_PROMPT,
     model: str = "gemini-3-pro-image-preview",
@@ -43,21 +56,14 @@ async def generate_image_from_references(
     Raises:
         ValueError: If no image in response or API error
     """
-    # Mock mode: return the first reference image as-is for smoke testing
-    if MOCK_MODE:
-        print("[MOCK MODE] No API key found, returning first reference image")
-        if reference_images:
-            return reference_images[0]
-        raise ValueError("No reference images provided in mock mode")
-    
-    # Create client (uses GOOGLE_API_KEY or GEMINI_API_KEY env var)
-    client = genai.Client(api_key=os.getenv("GEMINI_API_KEY"))
+    # Shared client (uses GOOGLE_API_KEY or GEMINI_API_KEY env var)
+    client = _get_client()
     
     # Build contents with prompt and reference images
     contents = [prompt]
     for img_bytes in reference_images:
         # Detect mime type from image bytes
-        mime_type = _detect_mime_type(img_bytes)
+        mime_type = detect_mime(img_bytes)
         contents.append(
             types.Part.from_bytes(
                 data=img_bytes,
@@ -66,8 +72,9 @@ async def generate_image_from_references(
         )
     
     try:
-        # Use generate_content (non-streaming) for simplicity in API
-        response = await client.aio.models.generate_content(
+        # Stream the response so each part is handled as it arrives instead of
+        # holding the whole multi-part response in memory at once
+        stream = await client.aio.models.generate_content_stream(
             model=model,
             contents=contents,
             config=types.GenerateContentConfig(
@@ -78,44 +85,32 @@ async def generate_image_from_references(
             ),
         )
         
-        generated_image_bytes = None
-        
-        # Iterate through parts to handle text and image
-        if response.candidates and response.candidates[0].content and response.candidates[0].content.parts:
-            for part in response.candidates[0].content.parts:
+        # Return the first image part as soon as it arrives
+        async for chunk in stream:
+            if not (chunk.candidates and chunk.candidates[0].content and chunk.candidates[0].content.parts):
+                continue
+            parts = chunk.candidates[0].content.parts
+            
+            # Handle Text (only logged when VERBOSE_GEMINI_TEXT is set)
+            if VERBOSE_GEMINI_TEXT:
+                for part in parts:
+                    if part.text:
+                        print(f"[Gemini Text]: {part.text}")
+            
+            # Handle Image (each inline_data part carries a complete image)
+            image_part = next((part for part in parts if part.inline_data), None)
+            if image_part is not None:
+                inline_data = image_part.inline_data
+                print(f"[Gemini Image] Received image with mime_type: {inline_data.mime_type}")
+                
+                # Save locally without holding up the response
+                _schedule_save(inline_data.data, inline_data.mime_type)
                 
-                # Handle Text
-                if part.text:
-                    print(f"[Gemini Text]: {part.text}")
+                # Release the connection instead of draining the rest of the stream
+                await stream.aclose()
                 
-                # Handle Image
-                if part.inline_data:
-                    inline_data = part.inline_data
-                    data = inline_data.data
-                    mime_type = inline_data.mime_type
-                    
-                    print(f"[Gemini Image] Received image with mime_type: {mime_type}")
-                    
-                    # It's raw bytes as per documentation logic
-                    generated_image_bytes = data
-                    
-                    # Save locally
-                    save_dir = "generated_images"
-                    if not os.path.exists(save_dir):
-                        os.makedirs(save_dir)
-                    
-                    import time
-                    import mimetypes
-                    timestamp = int(time.time())
-                    ext = mimetypes.guess_extension(mime_type) or ".png"
-                    filename = f"{save_dir}/gen_{timestamp}{ext}"
-                    
-                    with open(filename, "wb") as f:
-                        f.write(data)
-                    print(f"Saved generated image to {filename}")
-
-        if generated_image_bytes:
-            return generated_image_bytes
+                # It's raw bytes as per documentation logic
+                return inline_data.data
             
         raise ValueError("No image found in Gemini API response")
 
@@ -124,19 +119,44 @@ async def generate_image_from_references(
         if hasattr(e, 'response') and hasattr(e.response, 'prompt_feedback'):
              print(f"Safety Feedback: {e.response.prompt_feedback}")
         raise ValueError(f"Image generation failed: {str(e)}")
-    finally:
-        await client.aio.aclose()
-
-
-def _detect_mime_type(image_bytes: bytes) -> str:
-    """Detect image MIME type from magic bytes."""
-    if image_bytes[:8] == b'\x89PNG\r\n\x1a\n':
-        return "image/png"
-    elif image_bytes[:2] == b'\xff\xd8':
-        return "image/jpeg"
-    elif image_bytes[:4] == b'RIFF' and image_bytes[8:12] == b'WEBP':
-        return "image/webp"
-    elif image_bytes[:6] in (b'GIF87a', b'GIF89a'):
-        return "image/gif"
-    else:
-        return "image/png"  # Default fallback
+
+
+def _save_image(data: bytes, mime_type: str) -> None:
+    """Write a generated image to SAVE_DIR (blocking; runs in a worker thread)."""
+    timestamp = int(time.time())
+    ext = mimetypes.guess_extension(mime_type) or ".png"
+    filename = f"{SAVE_DIR}/gen_{timestamp}{ext}"
+    
+    try:
+        os.makedirs(SAVE_DIR, exist_ok=True)
+        with open(filename, "wb") as f:
+            f.write(data)
+        print(f"Saved generated image to {filename}")
+    except OSError as e:
+        print(f"Failed to save generated image to {filename}: {e}")
+
+
+def _schedule_save(data: bytes, mime_type: str) -> None:
+    """Save a generated image in the background, off the event loop."""
+    task = asyncio.create_task(asyncio.to_thread(_save_image, data, mime_type))
+    _SAVE_TASKS.add(task)
+    task.add_done_callback(_SAVE_TASKS.discard)
+
+
+async def _generate_mock(
+    reference_images: list[bytes],
+    prompt: str = DEFAULT_IMAGE_PROMPT,
+    model: str = "gemini-3-pro-image-preview",
+) -> bytes:
+    """Mock mode: return the first reference image as-is for smoke testing."""
+    if reference_images:
+        return reference_images[0]
+    raise ValueError("No reference images provided in mock mode")
+
+
+# Bind the implementation once at import time instead of branching per call
+if MOCK_MODE:
+    print("[MOCK MODE] No API key found, returning first reference image")
+    generate_image_from_references = _generate_mock
+else:
+    generate_image_from_references = _generate_with_gemini
@@ -7,28 +7,67 @@ from fastapi import FastAPI, HTTPException, File, UploadFile, Form
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import StreamingResponse, JSONResponse
 from pydantic import BaseModel
-from typing import Optional, List
+from typing import Optional, List, Literal, AsyncGenerator, AsyncIterator
+from contextlib import asynccontextmanager
 from dotenv import load_dotenv
+import asyncio
 import base64
+import json
+import logging
 import os
 
-from ai_assistant import stream_gemini_response, chat_with_history, generate_with_thinking
+from ai_assistant import (
+    close_client,
+    coalesced_gemini_response,
+    chat_with_history,
+    generate_with_thinking,
+    submit_thinking_batch,
+    get_thinking_batch
+)
 from constants import (
+    AVAILABLE_MODELS,
     DEFAULT_GEMINI_MODEL,
     GEMINI_3_PRO,
-    TEMPERATURE
+    INTERACTIVE_SERVICE_TIER,
+    TEMPERATURE,
+    STREAM_FLUSH_CHARS,
+    STREAM_FLUSH_INTERVAL,
+    SLOW_CALLBACK_SECONDS,
+    IMAGE_B64_CHUNK_BYTES,
+    settings
 )
 from image_generator import generate_image_from_references, MOCK_MODE
+from watermark import embed_watermark, decode_watermark, shutdown_pool, MAX_PAYLOAD_BYTES
 
 # Load environment variables
 load_dotenv()
 print("API KEY = ", os.getenv("GEMINI_API_KEY"))
 
+# Per-request diagnostics go through logging; DEBUG mode shows them
+logging.basicConfig(level=logging.DEBUG if settings.debug else logging.WARNING)
+log = logging.getLogger("g3h.api")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """App startup/shutdown hooks"""
+    if settings.debug:
+        # Log any event-loop step (e.g. parsing a streamed chunk) that blocks too long
+        loop = asyncio.get_running_loop()
+        loop.set_debug(True)
+        loop.slow_callback_duration = SLOW_CALLBACK_SECONDS
+    yield
+    # Close the shared Gemini HTTP session and its pooled connections
+    await close_client()
+    # Stop any watermark batch worker processes
+    shutdown_pool()
+
+
 # Initialize FastAPI app
 app = FastAPI(
     title="Gemini AI Backend",
     description="FastAPI backend with latest Gemini models (3 Pro, 2.5 Pro, 2.5 Flash)",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan
 )
 
 # Configure CORS
@@ -66,6 +105,7 @@ class ChatRequest(BaseModel):
     model: Optional[str] = DEFAULT_GEMINI_MODEL
     temperature: Optional[float] = TEMPERATURE
     max_tokens: Optional[int] = None
+    service_tier: Optional[Literal["standard", "flex", "priority"]] = INTERACTIVE_SERVICE_TIER
 
 
 class ChatHistoryRequest(BaseModel):
@@ -73,12 +113,16 @@ class ChatHistoryRequest(BaseModel):
     messages: List[dict]  # [{"role": "user/assistant", "content": "..."}]
     model: Optional[str] = DEFAULT_GEMINI_MODEL
     temperature: Optional[float] = TEMPERATURE
+    session_id: Optional[str] = None  # reuse converted history across turns
+    service_tier: Optional[Literal["standard", "flex", "priority"]] = INTERACTIVE_SERVICE_TIER
 
 
 class ThinkingRequest(BaseModel):
     """Thinking request model for complex reasoning"""
     prompt: str
     model: Optional[str] = GEMINI_3_PRO
+    # "flex" suits non-interactive jobs; "batch" queues the request and returns a job id to poll
+    service_tier: Optional[Literal["standard", "flex", "priority", "batch"]] = None
 
 
 class ModelsResponse(BaseModel):
@@ -86,6 +130,77 @@ class ModelsResponse(BaseModel):
     models: dict
 
 
+# ============================================================================
+# STREAMING HELPERS
+# ============================================================================
+
+async def buffer_stream(chunks: AsyncIterator[str]) -> AsyncGenerator[str, None]:
+    """
+    Merge tiny model chunks into fewer, larger writes
+
+    The first chunk goes out immediately to keep time-to-first-token low;
+    after that text is flushed once STREAM_FLUSH_CHARS have accumulated or
+    STREAM_FLUSH_INTERVAL seconds have passed since the buffer started filling.
+    """
+    loop = asyncio.get_running_loop()
+    iterator = chunks.__aiter__()
+    buffer: list[str] = []
+    size = 0
+    deadline = None
+    first = True
+    pending = None
+    try:
+        while True:
+            if pending is None:
+                pending = asyncio.ensure_future(iterator.__anext__())
+            timeout = None if deadline is None else max(0.0, deadline - loop.time())
+            # asyncio.wait (unlike wait_for) leaves the pending read running on timeout
+            done, _ = await asyncio.wait({pending}, timeout=timeout)
+            if done:
+                finished, pending = pending, None
+                try:
+                    chunk = finished.result()
+                except StopAsyncIteration:
+                    break
+                if first:
+                    first = False
+                    yield chunk
+                    continue
+                buffer.append(chunk)
+                size += len(chunk)
+                if deadline is None:
+                    deadline = loop.time() + STREAM_FLUSH_INTERVAL
+                if size < STREAM_FLUSH_CHARS:
+                    continue
+            if buffer:
+                yield "".join(buffer)
+                buffer.clear()
+                size = 0
+            deadline = None
+        if buffer:
+            yield "".join(buffer)
+    finally:
+        if pending is not None:
+            pending.cancel()
+
+
+def stream_base64_json(data: bytes, **fields) -> AsyncGenerator[bytes, None]:
+    """
+    Stream {"image": "<base64>", **fields} without building the full string
+    
+    The image is base64-encoded block by block from a memoryview, so the only
+    large buffer held is the raw image itself.
+    """
+    async def _generate():
+        view = memoryview(data)
+        yield b'{"image":"'
+        for start in range(0, len(view), IMAGE_B64_CHUNK_BYTES):
+            yield base64.b64encode(view[start:start + IMAGE_B64_CHUNK_BYTES])
+        # Remaining fields reuse json.dumps minus its opening brace
+        yield ('",' + json.dumps(fields)[1:] if fields else '"}').encode()
+    return _generate()
+
+
 # ============================================================================
 # GEMINI AI ENDPOINTS
 # ============================================================================
@@ -93,34 +208,7 @@ class ModelsResponse(BaseModel):
 @app.get("/api/models", response_model=ModelsResponse)
 async def get_available_models():
     """Get list of available Gemini models"""
-    return {
-        "models": {
-            "gemini-3-pro-preview": {
-                "name": "Gemini 3 Pro",
-                "description": "Best model for multimodal understanding",
-                "context_window": "1M tokens",
-                "use_case": "Complex multimodal tasks with text, images, video, audio"
-            },
-            "gemini-2.5-pro": {
-                "name": "Gemini 2.5 Pro",
-                "description": "State-of-the-art thinking model",
-                "context_window": "1M tokens",
-                "use_case": "Complex reasoning in code, math, and STEM domains"
-            },
-            "gemini-2.5-flash": {
-                "name": "Gemini 2.5 Flash",
-                "description": "Well-rounded with strong price-performance",
-                "context_window": "1M tokens",
-                "use_case": "Large-scale processing, low-latency, high volume tasks"
-            },
-            "gemini-2.5-flash-lite": {
-                "name": "Gemini 2.5 Flash Lite",
-                "description": "Fastest flash model optimized for cost-efficiency",
-                "context_window": "1M tokens",
-                "use_case": "Speed-prioritized applications with high throughput"
-            }
-        }
-    }
+    return {"models": AVAILABLE_MODELS}
 
 
 @app.post("/api/chat/stream")
@@ -133,16 +221,15 @@ async def stream_chat(request: ChatRequest):
     if not request.prompt or not request.prompt.strip():
         raise HTTPException(status_code=400, detail="Prompt cannot be empty")
 
-    async def generate():
-        async for chunk in stream_gemini_response(
-            prompt=request.prompt,
-            model_name=request.model,
-            temperature=request.temperature,
-            max_output_tokens=request.max_tokens
-        ):
-            yield chunk
+    chunks = coalesced_gemini_response(
+        prompt=request.prompt,
+        model_name=request.model,
+        temperature=request.temperature,
+        max_output_tokens=request.max_tokens,
+        service_tier=request.service_tier
+    )
 
-    return StreamingResponse(generate(), media_type="text/plain")
+    return StreamingResponse(buffer_stream(chunks), media_type="text/plain")
 
 
 @app.post("/api/chat/history")
@@ -155,15 +242,15 @@ async def chat_with_conversation_history(request: ChatHistoryRequest):
     if not request.messages or len(request.messages) == 0:
         raise HTTPException(status_code=400, detail="Messages cannot be empty")
 
-    async def generate():
-        async for chunk in chat_with_history(
-            messages=request.messages,
-            model_name=request.model,
-            temperature=request.temperature
-        ):
-            yield chunk
+    chunks = chat_with_history(
+        messages=request.messages,
+        model_name=request.model,
+        temperature=request.temperature,
+        session_id=request.session_id,
+        service_tier=request.service_tier
+    )
 
-    return StreamingResponse(generate(), media_type="text/plain")
+    return StreamingResponse(buffer_stream(chunks), media_type="text/plain")
 
 
 @app.post("/api/chat/thinking")
@@ -173,18 +260,38 @@ async def chat_with_thinking(request: ThinkingRequest):
 
     Uses Gemini 3 Pro or 2.5 Pro for complex reasoning
     Returns both thinking process and final response
+
+    With service_tier="batch" the request is queued on the Batch tier and
+    a job id is returned; poll GET /api/chat/thinking/{job_id} for the result.
     """
     if not request.prompt or not request.prompt.strip():
         raise HTTPException(status_code=400, detail="Prompt cannot be empty")
 
+    if request.service_tier == "batch":
+        return await submit_thinking_batch(
+            prompt=request.prompt,
+            model_name=request.model
+        )
+
     result = await generate_with_thinking(
         prompt=request.prompt,
-        model_name=request.model
+        model_name=request.model,
+        service_tier=request.service_tier
     )
 
     return result
 
 
+@app.get("/api/chat/thinking/{job_id:path}")
+async def get_thinking_job(job_id: str):
+    """
+    Poll a batch thinking job
+
+    Returns the job state, plus thinking process and final response once done
+    """
+    return await get_thinking_batch(job_id)
+
+
 # ============================================================================
 # IMAGE GENERATION ENDPOINTS
 # ============================================================================
@@ -209,13 +316,22 @@ async def generate_image(
     if len(files) > 5:
         raise HTTPException(status_code=400, detail="Maximum 5 reference images allowed")
     
-    # Read uploaded files
-    reference_images = []
-    for file in files:
-        content = await file.read()
+    # Reject oversize watermark payloads before paying for generation (the
+    # character count is a lower bound on the UTF-8 size, so check it first)
+    if watermark_text and (
+        len(watermark_text) > MAX_PAYLOAD_BYTES
+        or len(watermark_text.encode('utf-8')) > MAX_PAYLOAD_BYTES
+    ):
+        raise HTTPException(
+            status_code=400,
+            detail=f"Watermark payload too large: max {MAX_PAYLOAD_BYTES} bytes"
+        )
+    
+    # Read uploaded files concurrently, then validate in order
+    reference_images = await asyncio.gather(*(file.read() for file in files))
+    for file, content in zip(files, reference_images):
         if not content:
             raise HTTPException(status_code=400, detail=f"Empty file: {file.filename}")
-        reference_images.append(content)
     
     try:
         # Generate image
@@ -224,18 +340,20 @@ async def generate_image(
         # Embed watermark if text provided
         watermark_embedded = False
         if watermark_text and watermark_text.strip():
-            print(f"[Watermark] Embedding {len(watermark_text)} bytes of hidden data")
-            result_bytes = embed_watermark(result_bytes, watermark_text)
+            log.debug("[Watermark] Embedding %d bytes of hidden data", len(watermark_text))
+            # CPU-bound DWT/DCT work runs off the event loop
+            result_bytes = await asyncio.to_thread(embed_watermark, result_bytes, watermark_text)
             watermark_embedded = True
         
-        # Return as base64
-        result_base64 = base64.b64encode(result_bytes).decode('utf-8')
-        
-        return JSONResponse(content={
-            "image": result_base64,
-            "mock_mode": MOCK_MODE,
-            "watermark_embedded": watermark_embedded
-        })
+        # Return as base64, streamed in blocks
+        return StreamingResponse(
+            stream_base64_json(
+                result_bytes,
+                mock_mode=MOCK_MODE,
+                watermark_embedded=watermark_embedded
+            ),
+            media_type="application/json"
+        )
     except ValueError as e:
         raise HTTPException(status_code=500, detail=str(e))
     except Exception as e:
@@ -261,8 +379,8 @@ async def verify_image(file: UploadFile = File(...)):
     if not content:
         raise HTTPException(status_code=400, detail=f"Empty file: {file.filename}")
     
-    # Decode watermark from image
-    extracted_data = decode_watermark(content)
+    # Decode watermark from image (CPU-bound, so off the event loop)
+    extracted_data = await asyncio.to_thread(decode_watermark, content)
     has_watermark = extracted_data is not None and len(extracted_data) > 0
     
     if has_watermark:
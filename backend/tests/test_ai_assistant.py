@@ -0,0 +1,243 @@
+"""
+Test Gemini request plumbing without calling the API
+
+Fakes stand in for the upstream stream and the client so these run offline:
+1. Identical concurrent prompts share one upstream stream
+2. Long chat prefixes are pinned in a context cache and not resent
+3. Per-session history is rebuilt when earlier messages change
+"""
+
+import asyncio
+import time
+from collections import OrderedDict
+from types import SimpleNamespace
+
+import pytest
+
+import ai_assistant
+
+
+@pytest.fixture
+def fake_upstream(monkeypatch):
+    """Replace stream_gemini_response with a stream that pauses after its first chunk."""
+    calls = []
+    release = asyncio.Event()
+
+    async def fake_stream(**kwargs):
+        calls.append(kwargs)
+        yield "Hel"
+        await release.wait()
+        yield "lo"
+        yield "!"
+
+    monkeypatch.setattr(ai_assistant, "stream_gemini_response", fake_stream)
+    monkeypatch.setattr(ai_assistant, "_INFLIGHT_STREAMS", {})
+    return calls, release
+
+
+async def _collect(stream) -> str:
+    return "".join([chunk async for chunk in stream])
+
+
+async def _wait_for_first_chunk() -> ai_assistant._StreamFanout:
+    """Let the pump publish its first chunk; returns the in-flight fanout."""
+    while True:
+        fanouts = list(ai_assistant._INFLIGHT_STREAMS.values())
+        if fanouts and fanouts[0].chunks:
+            return fanouts[0]
+        await asyncio.sleep(0)
+
+
+class TestCoalescedStreams:
+    """Identical short prompts attach to the stream already in flight."""
+
+    @pytest.mark.asyncio
+    async def test_overlapping_consumers_share_upstream(self, fake_upstream):
+        """Three overlapping consumers get the full text from one upstream call."""
+        calls, release = fake_upstream
+
+        first = asyncio.create_task(_collect(ai_assistant.coalesced_gemini_response("hi")))
+        await _wait_for_first_chunk()
+
+        # Late subscribers replay the chunk that already arrived
+        late = [
+            asyncio.create_task(_collect(ai_assistant.coalesced_gemini_response("hi")))
+            for _ in range(2)
+        ]
+        await asyncio.sleep(0)
+        release.set()
+
+        assert await asyncio.gather(first, *late) == ["Hello!"] * 3
+        assert len(calls) == 1
+        assert ai_assistant._INFLIGHT_STREAMS == {}
+
+    @pytest.mark.asyncio
+    async def test_consumer_leaving_early(self, fake_upstream):
+        """A closed consumer does not stop the upstream, and the key is dropped when it ends."""
+        calls, release = fake_upstream
+
+        stream = ai_assistant.coalesced_gemini_response("hi")
+        assert await stream.__anext__() == "Hel"
+        fanout = await _wait_for_first_chunk()
+        await stream.aclose()
+
+        # A second consumer still attaches to the same upstream call
+        other = asyncio.create_task(_collect(ai_assistant.coalesced_gemini_response("hi")))
+        await asyncio.sleep(0)
+        release.set()
+
+        assert await other == "Hello!"
+        await fanout.task
+        assert len(calls) == 1
+        assert ai_assistant._INFLIGHT_STREAMS == {}
+
+
+class FakeCaches:
+    def __init__(self):
+        self.created = []
+
+    async def create(self, model, config):
+        self.created.append(config.contents)
+        return SimpleNamespace(name=f"cachedContents/{len(self.created)}")
+
+
+class FakeModels:
+    def __init__(self):
+        self.requests = []
+
+    async def generate_content_stream(self, model, contents, config):
+        self.requests.append((contents, config))
+
+        async def chunks():
+            yield SimpleNamespace(text="ok")
+
+        return chunks()
+
+
+@pytest.fixture
+def fake_client(monkeypatch):
+    """Offline client that records cache creation and generate requests."""
+    client = SimpleNamespace(aio=SimpleNamespace(caches=FakeCaches(), models=FakeModels()))
+    monkeypatch.setattr(ai_assistant, "_get_client", lambda: client)
+    monkeypatch.setattr(ai_assistant, "_PREFIX_CACHES", OrderedDict())
+    monkeypatch.setattr(ai_assistant, "_PENDING_CACHES", {})
+    monkeypatch.setattr(ai_assistant, "_HISTORY_CACHE", OrderedDict())
+    return client
+
+
+async def _chat(messages: list[dict], **kwargs) -> str:
+    text = await _collect(ai_assistant.chat_with_history(messages, **kwargs))
+    # Let the background cache creation finish
+    while ai_assistant._PENDING_CACHES:
+        await asyncio.sleep(0)
+    return text
+
+
+def _history(prefix_chars: int) -> list[dict]:
+    return [
+        {"role": "user", "content": "u" * prefix_chars},
+        {"role": "assistant", "content": "a"},
+        {"role": "user", "content": "next question"},
+    ]
+
+
+class TestPrefixCache:
+    """Long histories are cached server-side and only new messages are sent."""
+
+    @pytest.mark.asyncio
+    async def test_short_prefix_not_cached(self, fake_client):
+        """Prefixes under the model's minimum never create a cache."""
+        min_chars = ai_assistant._cache_min_chars("gemini-2.5-flash")
+        assert await _chat(_history(min_chars - 10)) == "ok"
+        assert fake_client.aio.caches.created == []
+
+    @pytest.mark.asyncio
+    async def test_cache_created_then_reused(self, fake_client):
+        """A long prefix is cached once; the next turn sends only what follows it."""
+        messages = _history(ai_assistant._cache_min_chars("gemini-2.5-flash"))
+
+        assert await _chat(messages) == "ok"
+        caches, models = fake_client.aio.caches, fake_client.aio.models
+        assert len(caches.created) == 1
+        assert len(caches.created[0]) == 2  # everything but the final message
+        contents, config = models.requests[0]
+        assert len(contents) == 3
+        assert config.cached_content is None
+
+        messages += [
+            {"role": "assistant", "content": "ok"},
+            {"role": "user", "content": "follow-up"},
+        ]
+        assert await _chat(messages) == "ok"
+        contents, config = models.requests[1]
+        assert config.cached_content == "cachedContents/1"
+        assert [content.parts[0].text for content in contents] == ["next question", "ok", "follow-up"]
+        assert len(caches.created) == 1
+
+    def test_expired_entry_dropped(self, fake_client):
+        """Expired caches are removed and the longest live prefix is used instead."""
+        digests = ai_assistant._prefix_digests("gemini-2.5-flash", _history(10))
+        now = time.monotonic()
+        ai_assistant._PREFIX_CACHES[digests[0]] = ("cachedContents/live", now + 60)
+        ai_assistant._PREFIX_CACHES[digests[1]] = ("cachedContents/stale", now - 1)
+
+        assert ai_assistant._lookup_prefix_cache(digests[:2]) == ("cachedContents/live", 1)
+        assert digests[1] not in ai_assistant._PREFIX_CACHES
+
+
+def _sent_texts(fake_client, turn: int) -> list[str]:
+    contents, _ = fake_client.aio.models.requests[turn]
+    return [content.parts[0].text for content in contents]
+
+
+class TestSessionHistory:
+    """Converted history is reused per session only while its prefix is unchanged."""
+
+    @pytest.mark.asyncio
+    async def test_appended_history_reused(self, fake_client):
+        """New turns on an unchanged history are appended to the stored contents."""
+        messages = [{"role": "user", "content": "first"}]
+        await _chat(messages, session_id="s")
+        messages += [{"role": "assistant", "content": "reply"}, {"role": "user", "content": "second"}]
+        await _chat(messages, session_id="s")
+
+        assert _sent_texts(fake_client, 1) == ["first", "reply", "second"]
+
+    @pytest.mark.asyncio
+    async def test_edited_history_rebuilt(self, fake_client):
+        """Changing the first message sends the full new history, not the stale list."""
+        await _chat(
+            [
+                {"role": "user", "content": "first"},
+                {"role": "assistant", "content": "reply"},
+                {"role": "user", "content": "second"},
+            ],
+            session_id="s",
+        )
+        await _chat(
+            [
+                {"role": "user", "content": "edited"},
+                {"role": "assistant", "content": "reply"},
+                {"role": "user", "content": "second"},
+                {"role": "assistant", "content": "ok"},
+                {"role": "user", "content": "third"},
+            ],
+            session_id="s",
+        )
+
+        assert _sent_texts(fake_client, 1) == ["edited", "reply", "second", "ok", "third"]
+
+    @pytest.mark.asyncio
+    async def test_truncated_history_rebuilt(self, fake_client):
+        """A shorter history (e.g. regenerating an earlier turn) drops the stale tail."""
+        await _chat(
+            [
+                {"role": "user", "content": "first"},
+                {"role": "assistant", "content": "reply"},
+                {"role": "user", "content": "second"},
+            ],
+            session_id="s",
+        )
+        await _chat([{"role": "user", "content": "first"}], session_id="s")
+
+        assert _sent_texts(fake_client, 1) == ["first"]
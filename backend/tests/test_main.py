@@ -0,0 +1,148 @@
+"""
+Test API helpers and request validation without calling Gemini
+
+1. buffer_stream merges small chunks without delaying the first one
+2. Oversize watermark payloads are rejected before generation
+"""
+
+import asyncio
+from pathlib import Path
+from typing import Optional, Sequence
+
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+
+
+async def _source(
+    chunks: list[str],
+    release: Optional[asyncio.Event] = None,
+    then: Sequence[str] = (),
+    cancelled: Optional[list] = None,
+):
+    """Yield `chunks`, optionally wait for `release`, then yield `then`."""
+    for chunk in chunks:
+        yield chunk
+    if release is not None:
+        try:
+            await release.wait()
+        except asyncio.CancelledError:
+            if cancelled is not None:
+                cancelled.append(True)
+            raise
+    for chunk in then:
+        yield chunk
+
+
+async def _collect(stream) -> list[str]:
+    return [chunk async for chunk in stream]
+
+
+class TestBufferStream:
+    """Timer-and-size flushing of streamed model text."""
+
+    @pytest.mark.asyncio
+    async def test_first_chunk_immediate(self):
+        """The first chunk is sent without waiting for more text or the timer."""
+        release = asyncio.Event()
+        stream = main.buffer_stream(_source(["Hi"], release))
+        assert await asyncio.wait_for(stream.__anext__(), timeout=main.STREAM_FLUSH_INTERVAL / 2) == "Hi"
+        await stream.aclose()
+
+    @pytest.mark.asyncio
+    async def test_merges_up_to_flush_chars(self):
+        """Chunks arriving together are merged and flushed once STREAM_FLUSH_CHARS is reached."""
+        piece = "b" * (main.STREAM_FLUSH_CHARS // 4)
+        chunks = ["first"] + [piece] * 4 + ["x", "y"]
+
+        assert await _collect(main.buffer_stream(_source(chunks))) == ["first", piece * 4, "xy"]
+
+    @pytest.mark.asyncio
+    async def test_flushes_on_interval(self):
+        """Buffered text goes out at the STREAM_FLUSH_INTERVAL deadline while the source is idle."""
+        release = asyncio.Event()
+        stream = main.buffer_stream(_source(["first", "a"], release, then=["b"]))
+
+        assert await stream.__anext__() == "first"
+        # The source is still blocked, so only the timer can flush "a"
+        assert await asyncio.wait_for(stream.__anext__(), timeout=1) == "a"
+        release.set()
+        assert await _collect(stream) == ["b"]
+
+    @pytest.mark.asyncio
+    async def test_empty_stream(self):
+        assert await _collect(main.buffer_stream(_source([]))) == []
+
+    @pytest.mark.asyncio
+    async def test_aclose_cancels_pending_read(self):
+        """Closing mid-stream cancels the in-flight read instead of leaking it."""
+        release, cancelled = asyncio.Event(), []
+        stream = main.buffer_stream(_source(["first", "a"], release, cancelled=cancelled))
+
+        assert await stream.__anext__() == "first"
+        assert await stream.__anext__() == "a"  # timer flush; the next read is in flight
+        await stream.aclose()
+        await asyncio.sleep(0)
+
+        assert cancelled == [True]
+        assert asyncio.all_tasks() == {asyncio.current_task()}
+
+
+@pytest.fixture
+def client(monkeypatch):
+    """API client whose image generation echoes the first reference image."""
+    calls = []
+
+    async def fake_generate(reference_images):
+        calls.append(reference_images)
+        return reference_images[0]
+
+    monkeypatch.setattr(main, "generate_image_from_references", fake_generate)
+    test_client = TestClient(main.app)
+    test_client.generate_calls = calls
+    return test_client
+
+
+@pytest.fixture
+def kd_image_bytes():
+    kd_path = Path(__file__).parent.parent / "kd.jpeg"
+    assert kd_path.exists(), f"Test image not found: {kd_path}"
+    return kd_path.read_bytes()
+
+
+class TestGenerateImagePayloadLimit:
+    """watermark_text is limited to MAX_PAYLOAD_BYTES of UTF-8."""
+
+    def _post(self, client, image_bytes: bytes, watermark_text: str):
+        return client.post(
+            "/api/generate-image",
+            files=[("files", ("kd.jpeg", image_bytes, "image/jpeg"))],
+            data={"watermark_text": watermark_text},
+        )
+
+    def test_too_many_characters_rejected(self, client, kd_image_bytes):
+        """More characters than bytes allowed is rejected before generation."""
+        response = self._post(client, kd_image_bytes, "a" * (main.MAX_PAYLOAD_BYTES + 1))
+
+        assert response.status_code == 400
+        assert "too large" in response.json()["detail"]
+        assert client.generate_calls == []
+
+    def test_too_many_bytes_rejected(self, client, kd_image_bytes):
+        """Few enough characters but too many UTF-8 bytes is also rejected."""
+        response = self._post(client, kd_image_bytes, "é" * 300)
+
+        assert response.status_code == 400
+        assert client.generate_calls == []
+
+    def test_multibyte_payload_under_limit_accepted(self, client, kd_image_bytes):
+        """200 x "é" is 400 bytes of UTF-8, under the limit, so it is embedded."""
+        payload = "é" * 200
+        assert len(payload.encode("utf-8")) == 400
+
+        response = self._post(client, kd_image_bytes, payload)
+
+        assert response.status_code == 200, response.text
+        assert response.json()["watermark_embedded"] is True
+        assert len(client.generate_calls) == 1
@@ -107,6 +107,40 @@ class TestWatermarkModule:
         assert decoded is not None
         assert test_text in decoded, f"Expected '{test_text}' in '{decoded}'"
     
+    def test_png_roundtrip(self, kd_image_bytes):
+        """Lossless output must decode with the scales used at embed time."""
+        from watermark import embed_watermark, decode_watermark
+        
+        test_text = "scales"
+        
+        watermarked = embed_watermark(kd_image_bytes, test_text, output_format="PNG")
+        assert decode_watermark(watermarked) == test_text
+    
+    def test_fallback_method_roundtrip(self, monkeypatch):
+        """Images written with FALLBACK_METHOD pass the pre-check and decode."""
+        import cv2
+        import numpy as np
+        import watermark
+        from imwatermark.dwtDctSvd import EmbedDwtDctSvd
+        
+        def fail(*args, **kwargs):
+            raise RuntimeError("primary method unavailable")
+        
+        # FALLBACK_METHOD only round-trips where each block's peak value is
+        # stable, like a flat frame; this colour also scores below the
+        # PRIMARY_METHOD pre-check, so only the fallback score admits it
+        frame = np.full((1200, 1200, 3), (144, 128, 128), dtype=np.uint8)
+        image_bytes = cv2.imencode(".png", frame)[1].tobytes()
+        test_text = "fallback"
+        
+        # Force _encode_section down to FALLBACK_METHOD for the embed only
+        with monkeypatch.context() as patch:
+            patch.setattr(watermark, "FAST_PATH", False)
+            patch.setattr(EmbedDwtDctSvd, "encode", fail)
+            watermarked = watermark.embed_watermark(image_bytes, test_text, output_format="PNG")
+        
+        assert watermark.decode_watermark(watermarked) == test_text
+    
     def test_json_payload(self, kd_image_bytes):
         """Test with JSON payload like production use."""
         from watermark import embed_watermark, decode_watermark
@@ -118,3 +152,45 @@ class TestWatermarkModule:
         
         assert decoded is not None
         assert payload in decoded
+    
+    def test_no_corrupted_payload(self, kd_image_bytes):
+        """A lossy round trip recovers the exact payload, not a corrupted string."""
+        from watermark import embed_watermark, decode_watermark
+        
+        payload = '{"user_id": "abc123", "tier": "premium"}'
+        
+        watermarked = embed_watermark(kd_image_bytes, payload, output_format="JPEG")
+        assert decode_watermark(watermarked) == payload
+    
+    def test_webp_roundtrip(self, kd_image_bytes):
+        """WEBP output keeps enough of the watermark to verify."""
+        from watermark import embed_watermark, decode_watermark
+        
+        payload = "payload-123"
+        
+        watermarked = embed_watermark(kd_image_bytes, payload, output_format="WEBP")
+        assert watermarked[8:12] == b"WEBP"
+        assert decode_watermark(watermarked) == payload
+    
+    def test_non_image_input(self):
+        """Junk and tiny inputs return None without running the decoder."""
+        import cv2
+        import numpy as np
+        from watermark import decode_watermark
+        
+        assert decode_watermark(b"") is None
+        assert decode_watermark(b"not an image at all") is None
+        
+        tiny_png = cv2.imencode(".png", np.zeros((64, 64, 3), dtype=np.uint8))[1].tobytes()
+        assert decode_watermark(tiny_png) is None
+    
+    def test_batch_roundtrip(self, kd_image_bytes):
+        """Batch embed/decode keeps payloads paired with their images."""
+        from watermark import embed_watermark_batch, decode_watermark_batch, shutdown_pool
+        
+        payloads = ["first image", "second image"]
+        try:
+            watermarked = embed_watermark_batch([kd_image_bytes] * 2, payloads, output_format="PNG")
+            assert decode_watermark_batch(watermarked) == payloads
+        finally:
+            shutdown_pool()